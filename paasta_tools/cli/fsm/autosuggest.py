@@ -16,6 +16,11 @@ import random
 
 import yaml
 
+try:
+    from yaml.cyaml import CSafeLoader as Loader
+except ImportError:  # pragma: no cover (no libyaml-dev / pypy)
+    Loader = yaml.SafeLoader  # type: ignore
+
 
 def _get_smartstack_proxy_ports_from_file(root, file):
     """Given a root and file (as from os.walk), attempt to return the highest
@@ -23,8 +28,8 @@ def _get_smartstack_proxy_ports_from_file(root, file):
     smartstack proxy_port.
     """
     ports = set()
-    with open(os.path.join(root, file)) as f:
-        data = yaml.safe_load(f)
+    with open(os.path.join(root, file), "rb") as f:
+        data = yaml.load(f, Loader=Loader)
 
     if file.endswith("service.yaml") and "smartstack" in data:
         # Specifying this in service.yaml is old and deprecated and doesn't
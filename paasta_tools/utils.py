@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import atexit
 import contextlib
 import copy
 import datetime
@@ -28,6 +29,7 @@ import os
 import pwd
 import queue
 import re
+import selectors
 import shlex
 import signal
 import socket
@@ -45,6 +47,7 @@ from functools import wraps
 from subprocess import PIPE
 from subprocess import Popen
 from subprocess import STDOUT
+from subprocess import TimeoutExpired
 from types import FrameType
 from typing import Any
 from typing import Callable
@@ -102,7 +105,10 @@ DEPLOY_PIPELINE_NON_DEPLOY_STEPS = (
 ANY_CLUSTER = "N/A"
 ANY_INSTANCE = "N/A"
 DEFAULT_LOGLEVEL = "event"
-no_escape = re.compile(r"\x1B\[[0-9;]*[mK]")
+no_escape = re.compile(r"\x1B\[[0-?]*[ -/]*[@-~]")
+# Stray control characters (BEL, FF, CR) that terminals act on but that
+# shouldn't end up in logs; removed with str.translate rather than a regex.
+_CONTROL_CHARACTERS_TABLE = dict.fromkeys([0x07, 0x0C, 0x0D])
 
 # instead of the convention of using underscores in this scribe channel name,
 # the audit log uses dashes to prevent collisions with a service that might be
@@ -1072,6 +1078,9 @@ class PaastaColors:
         :param color: ANSI color code
         :param text: a string
         :return: a string with ANSI color encoding"""
+        # plain text (the common case) has nothing to re-color.
+        if PaastaColors.DEFAULT not in text:
+            return color + text + PaastaColors.DEFAULT
         # any time text returns to default, we want to insert our color.
         replaced = text.replace(PaastaColors.DEFAULT, PaastaColors.DEFAULT + color)
         # then wrap the beginning and end in our color/default.
@@ -1199,6 +1208,7 @@ LOG_COMPONENTS: Mapping[str, Mapping[str, Any]] = OrderedDict(
         # }),
     ]
 )
+_LOG_COMPONENT_NAMES: FrozenSet[str] = frozenset(LOG_COMPONENTS)
 
 
 class NoSuchLogComponent(Exception):
@@ -1206,10 +1216,10 @@ class NoSuchLogComponent(Exception):
 
 
 def validate_log_component(component: str) -> bool:
-    if component in LOG_COMPONENTS.keys():
+    if component in _LOG_COMPONENT_NAMES:
         return True
     else:
-        raise NoSuchLogComponent
+        raise NoSuchLogComponent(component)
 
 
 def get_git_url(service: str, soa_dir: str = DEFAULT_SOA_DIR) -> str:
@@ -1374,15 +1384,43 @@ def _log_audit(
     )
 
 
+# (epoch second, its formatted "%Y-%m-%dT%H:%M:%S" prefix), shared by every
+# _now call within that second. Races between threads are benign.
+_now_second_prefix: Tuple[int, str] = (0, "")
+
+
 def _now() -> str:
-    return datetime.datetime.utcnow().isoformat()
+    global _now_second_prefix
+    now = time.time()
+    second = int(now)
+    cached_second, prefix = _now_second_prefix
+    if cached_second != second:
+        prefix = datetime.datetime.utcfromtimestamp(second).strftime(
+            "%Y-%m-%dT%H:%M:%S"
+        )
+        _now_second_prefix = (second, prefix)
+    return "%s.%06d" % (prefix, int((now - second) * 1000000))
 
 
 def remove_ansi_escape_sequences(line: str) -> str:
-    """Removes ansi escape sequences from the given line."""
+    """Removes ansi escape sequences and stray BEL/FF/CR characters from the
+    given line."""
+    line = line.translate(_CONTROL_CHARACTERS_TABLE)
+    # Most lines (e.g. subprocess output) contain no escapes at all, so skip
+    # the regex engine entirely when there is no ESC character.
+    if "\x1b" not in line:
+        return line
     return no_escape.sub("", line)
 
 
+# Equivalent to json.dumps(..., sort_keys=True) of a log line dict; the keys
+# are fixed, so only the values need to be serialized for each line.
+_LOG_LINE_TEMPLATE = (
+    '{"cluster": %s, "component": %s, "instance": %s, "level": %s, '
+    '"message": %s, "service": %s, "timestamp": %s}'
+)
+
+
 def format_log_line(
     level: str,
     cluster: str,
@@ -1401,17 +1439,14 @@ def format_log_line(
     if not timestamp:
         timestamp = _now()
     line = remove_ansi_escape_sequences(line.strip())
-    message = json.dumps(
-        {
-            "timestamp": timestamp,
-            "level": level,
-            "cluster": cluster,
-            "service": service,
-            "instance": instance,
-            "component": component,
-            "message": line,
-        },
-        sort_keys=True,
+    message = _LOG_LINE_TEMPLATE % (
+        json.dumps(cluster),
+        json.dumps(component),
+        json.dumps(instance),
+        json.dumps(level),
+        json.dumps(line),
+        json.dumps(service),
+        json.dumps(timestamp),
     )
     return message
 
@@ -1464,6 +1499,89 @@ def get_log_name_for_service(service: str, prefix: str = None) -> str:
     return "stream_paasta_%s" % service
 
 
+class _BackgroundLineWriter:
+    """Hands (log_name, line) pairs to write_line from a single daemon thread,
+    in the order they were written.
+
+    If the queue is full, write() blocks for up to put_timeout seconds for the
+    thread to catch up, and drops the line (with a note on stderr) after that.
+    """
+
+    def __init__(
+        self,
+        write_line: Callable[[str, str], None],
+        maxsize: int = 10000,
+        put_timeout: float = 10,
+    ) -> None:
+        self.write_line = write_line
+        self.put_timeout = put_timeout
+        self._queue: "queue.Queue[Tuple[str, str]]" = queue.Queue(maxsize=maxsize)
+        self._worker = threading.Thread(
+            target=self._drain_queue, name="log-line-writer", daemon=True
+        )
+        self._worker.start()
+
+    def _drain_queue(self) -> None:
+        while True:
+            log_name, line = self._queue.get()
+            try:
+                self.write_line(log_name, line)
+            except Exception as e:
+                print(
+                    "Could not log to {}: {}: {} -- would have logged: {}".format(
+                        log_name, type(e).__name__, str(e), line
+                    ),
+                    file=sys.stderr,
+                )
+            finally:
+                self._queue.task_done()
+
+    def write(self, log_name: str, line: str) -> None:
+        try:
+            self._queue.put((log_name, line), timeout=self.put_timeout)
+        except queue.Full:
+            print(
+                "Could not log to {}: log queue is full -- would have logged: {}".format(
+                    log_name, line
+                ),
+                file=sys.stderr,
+            )
+
+    def flush(self, timeout: float = 10) -> None:
+        """Waits up to timeout seconds for every queued line to be handed to
+        write_line, so a stalled scribe can't hang process exit. Lines that are
+        still queued after that are dropped.
+        """
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._queue.all_tasks_done.wait(remaining)
+
+
+# The process-wide writer used by CLogWriter.log; see _get_log_line_writer.
+_log_line_writer: Optional[_BackgroundLineWriter] = None
+_log_line_writer_lock = threading.Lock()
+
+
+def _get_log_line_writer() -> _BackgroundLineWriter:
+    """Returns the background writer that hands log lines to clog, so callers
+    (e.g. _run reading a chatty subprocess) don't wait on scribe for every
+    line. It is started once per process, however many times configure_log
+    creates a new CLogWriter.
+    """
+    global _log_line_writer
+    with _log_line_writer_lock:
+        if _log_line_writer is None:
+            _log_line_writer = _BackgroundLineWriter(
+                lambda log_name, line: clog.log_line(log_name, line)
+            )
+            atexit.register(_log_line_writer.flush)
+    return _log_line_writer
+
+
 try:
     import clog
 
@@ -1497,7 +1615,7 @@ try:
             formatted_line = format_log_line(
                 level, cluster, service, instance, component, line
             )
-            clog.log_line(log_name, formatted_line)
+            _get_log_line_writer().write(log_name, formatted_line)
 
         def log_audit(
             self,
@@ -1749,6 +1867,17 @@ def get_readable_files_in_glob(glob: str, path: str) -> List[str]:
     return sorted(globbed_files)
 
 
+def _file_cache_key(path: str) -> Tuple[int, int, int, int]:
+    """Returns a key that changes whenever the file at path is modified or
+    replaced, even by a copy that preserves size and mtime (cp -p, rsync -t).
+
+    Unlike a whole os.stat_result, this ignores access times, so merely reading
+    a file doesn't invalidate caches keyed on it.
+    """
+    st = os.stat(path)
+    return st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns
+
+
 class ClusterAutoscalingResource(TypedDict):
     type: str
     id: str
@@ -1925,7 +2054,7 @@ def load_system_paasta_config(
     try:
         file_stats = frozenset(
             {
-                (fn, os.stat(fn))
+                (fn, _file_cache_key(fn))
                 for fn in get_readable_files_in_glob(glob="*.json", path=path)
             }
         )
@@ -1951,9 +2080,9 @@ def optionally_load_system_paasta_config(
 
 @lru_cache()
 def parse_system_paasta_config(
-    file_stats: FrozenSet[Tuple[str, os.stat_result]], path: str
+    file_stats: FrozenSet[Tuple[str, Tuple[int, int, int, int]]], path: str
 ) -> "SystemPaastaConfig":
-    """Pass in a dictionary of filename -> os.stat_result, and this returns the merged parsed configs"""
+    """Pass in a set of (filename, _file_cache_key(filename)) pairs, and this returns the merged parsed configs"""
     config: SystemPaastaConfigDict = {}
     for filename, _ in file_stats:
         with open(filename) as f:
@@ -2528,9 +2657,38 @@ class SystemPaastaConfig:
         return self.config_dict.get("hpa_always_uses_external_for_signalfx", False)
 
 
+def _read_lines_until(process: Popen, deadline: float) -> Iterator[bytes]:
+    """Helper function for _run. Yields the lines written to the process'
+    stdout until it is closed. If the monotonic clock passes deadline first,
+    the process is killed with _timeout and no further output is read.
+    """
+    fd = process.stdout.fileno()
+    pending = b""
+    # Unlike select.select, selectors isn't limited to fds below FD_SETSIZE.
+    with selectors.DefaultSelector() as selector:
+        selector.register(fd, selectors.EVENT_READ)
+        while True:
+            # Check the deadline on every pass: a child that never stops
+            # writing always has the pipe readable.
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not selector.select(remaining):
+                _timeout(process)
+                break
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            lines = chunk.split(b"\n")
+            lines[0] = pending + lines[0]
+            pending = lines.pop()
+            for line in lines:
+                yield line + b"\n"
+    if pending:
+        yield pending
+
+
 def _run(
     command: Union[str, List[str]],
-    env: Mapping[str, str] = os.environ,
+    env: Optional[Mapping[str, str]] = None,
     timeout: float = None,
     log: bool = False,
     stream: bool = False,
@@ -2542,6 +2700,8 @@ def _run(
     """Given a command, run it. Return a tuple of the return code and any
     output.
 
+    :param env: The environment for the command. If None (the default), the
+        command inherits this process' environment without it being copied.
     :param timeout: If specified, the command will be terminated after timeout
         seconds.
     :param log: If True, the _log will be handled by _run. If set, it is mandatory
@@ -2553,6 +2713,7 @@ def _run(
     magic.
     """
     output: List[str] = []
+    raw_output = bytearray()
     if log:
         service = kwargs["service"]
         component = kwargs["component"]
@@ -2578,27 +2739,42 @@ def _run(
             signal.signal(signal.SIGINT, signal_handler)
             signal.signal(signal.SIGTERM, signal_handler)
 
-        # start the timer if we specified a timeout
         if timeout:
-            proctimer = threading.Timer(timeout, _timeout, [process])
-            proctimer.start()
-
-        outfn: Any = print if stream else output.append
-        for linebytes in iter(process.stdout.readline, b""):
-            line = linebytes.decode("utf-8", errors="replace").rstrip("\n")
-            outfn(line)
-
-            if log:
-                _log(
-                    service=service,
-                    line=line,
-                    component=component,
-                    level=loglevel,
-                    cluster=cluster,
-                    instance=instance,
-                )
+            deadline = time.monotonic() + timeout
+            lines: Iterable[bytes] = _read_lines_until(process, deadline)
+        else:
+            # Iterating the buffered pipe directly avoids a Python-level
+            # readline call per line.
+            lines = process.stdout
+
+        for linebytes in lines:
+            # Unless a line has to be printed or logged, keep the raw bytes and
+            # decode the whole output once at the end.
+            if stream or log:
+                line = linebytes.decode("utf-8", errors="replace").rstrip("\n")
+                if stream:
+                    print(line)
+                if log:
+                    _log(
+                        service=service,
+                        line=line,
+                        component=component,
+                        level=loglevel,
+                        cluster=cluster,
+                        instance=instance,
+                    )
+            if not stream:
+                raw_output += linebytes
         # when finished, get the exit code
-        process.wait()
+        if timeout:
+            # stdout may have been closed well before the process exits
+            try:
+                process.wait(timeout=max(0.0, deadline - time.monotonic()))
+            except TimeoutExpired:
+                _timeout(process)
+                process.wait()
+        else:
+            process.wait()
         returncode = process.returncode
     except OSError as e:
         if log:
@@ -2612,15 +2788,12 @@ def _run(
             )
         output.append(e.strerror.rstrip("\n"))
         returncode = e.errno
-    except (KeyboardInterrupt, SystemExit):
-        # need to clean up the timing thread here
-        if timeout:
-            proctimer.cancel()
-        raise
-    else:
-        # Stop the timer
-        if timeout:
-            proctimer.cancel()
+    if raw_output:
+        text = raw_output.decode("utf-8", errors="replace")
+        # Lines are returned newline-separated, without a trailing newline
+        if text.endswith("\n"):
+            text = text[:-1]
+        output.insert(0, text)
     if returncode == -9:
         output.append(f"Command '{command}' timed out (longer than {timeout}s)")
     return returncode, "\n".join(output)
@@ -2643,6 +2816,9 @@ def get_user_agent() -> str:
         return f"PaaSTA Tools {paasta_tools.__version__}"
 
 
+ATOMIC_FILE_WRITE_BUFFER_SIZE = 64 * 1024
+
+
 @contextlib.contextmanager
 def atomic_file_write(target_path: str) -> Iterator[IO]:
     dirname = os.path.dirname(target_path)
@@ -2651,11 +2827,13 @@ def atomic_file_write(target_path: str) -> Iterator[IO]:
     if target_path == "-":
         yield sys.stdout
     else:
-        with tempfile.NamedTemporaryFile(
-            dir=dirname, prefix=(".%s-" % basename), delete=False, mode="w"
-        ) as f:
-            temp_target_path = f.name
+        fd, temp_target_path = tempfile.mkstemp(dir=dirname, prefix=(".%s-" % basename))
+        # Callers tend to dump YAML/JSON in many small writes; a larger buffer
+        # coalesces those into far fewer write syscalls.
+        with open(fd, "w", buffering=ATOMIC_FILE_WRITE_BUFFER_SIZE) as f:
             yield f
+            f.flush()
+            os.fsync(f.fileno())
 
         mode = 0o0666 & (~get_umask())
         os.chmod(temp_target_path, mode)
@@ -2735,8 +2913,11 @@ def build_docker_tag(service: str, upstream_git_commit: str) -> str:
     upstream_git_commit is the SHA that we're building. Usually this is the
     tip of origin/master.
     """
-    tag = "{}:paasta-{}".format(build_docker_image_name(service), upstream_git_commit)
-    return tag
+    return _docker_tag_for_image(build_docker_image_name(service), upstream_git_commit)
+
+
+def _docker_tag_for_image(image_name: str, upstream_git_commit: str) -> str:
+    return f"{image_name}:paasta-{upstream_git_commit}"
 
 
 def check_docker_image(service: str, tag: str) -> bool:
@@ -2745,18 +2926,23 @@ def check_docker_image(service: str, tag: str) -> bool:
     :raises: ValueError if more than one docker image with :tag: found.
     :returns: True if there is exactly one matching image found.
     """
-    docker_client = get_docker_client()
+    docker_client = _get_shared_docker_client()
+    # build_docker_image_name reads the service's config, so only do it once.
     image_name = build_docker_image_name(service)
-    docker_tag = build_docker_tag(service, tag)
+    docker_tag = _docker_tag_for_image(image_name, tag)
     images = docker_client.images(name=image_name)
-    # image['RepoTags'] may be None
-    # Fixed upstream but only in docker-py 2.
-    # https://github.com/docker/docker-py/issues/1401
-    result = [image for image in images if docker_tag in (image["RepoTags"] or [])]
-    if len(result) > 1:
-        raise ValueError(
-            f"More than one docker image found with tag {docker_tag}\n{result}"
-        )
+    result = []
+    for image in images:
+        # image['RepoTags'] may be None
+        # Fixed upstream but only in docker-py 2.
+        # https://github.com/docker/docker-py/issues/1401
+        if docker_tag in (image["RepoTags"] or ()):
+            result.append(image)
+            # No need to look at the rest once we know the tag is ambiguous
+            if len(result) > 1:
+                raise ValueError(
+                    f"More than one docker image found with tag {docker_tag}\n{result}"
+                )
     return len(result) == 1
 
 
@@ -2780,7 +2966,16 @@ def get_username() -> str:
     environment variable if present.
     http://stackoverflow.com/a/2899055
     """
-    return os.environ.get("SUDO_USER", pwd.getpwuid(os.getuid())[0])
+    sudo_user = os.environ.get("SUDO_USER")
+    if sudo_user is not None:
+        return sudo_user
+    return _get_username_for_uid(os.getuid())
+
+
+@lru_cache(maxsize=None)
+def _get_username_for_uid(uid: int) -> str:
+    # getpwuid can go through NSS (LDAP, sssd, ...), so only do it once per uid.
+    return pwd.getpwuid(uid)[0]
 
 
 def get_hostname() -> str:
@@ -2804,15 +2999,20 @@ def get_soa_cluster_deploy_files(
     else:
         instance_types = "|".join(INSTANCE_TYPES)
 
-    search_re = r"/.*/(" + instance_types + r")-(" + valid_clusters + r")\.yaml$"
+    search_re = re.compile(
+        r"/.*/(" + instance_types + r")-(" + valid_clusters + r")\.yaml$"
+    )
 
     for yaml_file in glob.glob("%s/*.yaml" % service_path):
+        # Only files that name a known cluster need the readability check, so
+        # don't open every other yaml file in the service directory.
+        cluster_re_match = search_re.search(yaml_file)
+        if cluster_re_match is None:
+            continue
         try:
             with open(yaml_file):
-                cluster_re_match = re.search(search_re, yaml_file)
-                if cluster_re_match is not None:
-                    cluster = cluster_re_match.group(2)
-                    yield (cluster, yaml_file)
+                cluster = cluster_re_match.group(2)
+                yield (cluster, yaml_file)
         except IOError as err:
             print(f"Error opening {yaml_file}: {err}")
 
@@ -2828,12 +3028,14 @@ def list_clusters(
     :param service: The service name. If unspecified, clusters running any service will be included.
     :returns: A sorted list of cluster names
     """
-    clusters = set()
-    for cluster, _ in get_soa_cluster_deploy_files(
-        service=service, soa_dir=soa_dir, instance_type=instance_type
-    ):
-        clusters.add(cluster)
-    return sorted(clusters)
+    return sorted(
+        {
+            cluster
+            for cluster, _ in get_soa_cluster_deploy_files(
+                service=service, soa_dir=soa_dir, instance_type=instance_type
+            )
+        }
+    )
 
 
 def list_all_instances_for_service(
@@ -3061,6 +3263,22 @@ def get_docker_client() -> Client:
         return Client(base_url=get_docker_host(), **client_opts)
 
 
+_shared_docker_client: Optional[Client] = None
+_shared_docker_client_lock = threading.Lock()
+
+
+def _get_shared_docker_client() -> Client:
+    """Returns a docker client that is created on first use and then reused
+    for the rest of the process, so repeated callers don't reconnect each time.
+    """
+    global _shared_docker_client
+    if _shared_docker_client is None:
+        with _shared_docker_client_lock:
+            if _shared_docker_client is None:
+                _shared_docker_client = get_docker_client()
+    return _shared_docker_client
+
+
 def get_running_mesos_docker_containers() -> List[Dict]:
     client = get_docker_client()
     running_containers = client.containers()
@@ -16,6 +16,7 @@ import json
 import os
 import stat
 import sys
+import threading
 import time
 import warnings
 from typing import Any
@@ -134,6 +135,17 @@ def test_format_log_line_with_timestamp():
     assert actual == expected
 
 
+def test_now():
+    with mock.patch(
+        "paasta_tools.utils.time.time", autospec=True, return_value=1500000000.25
+    ):
+        assert utils._now() == "2017-07-14T02:40:00.250000"
+    with mock.patch(
+        "paasta_tools.utils.time.time", autospec=True, return_value=1500000001.5
+    ):
+        assert utils._now() == "2017-07-14T02:40:01.500000"
+
+
 def test_format_log_line_rejects_invalid_components():
     with raises(utils.NoSuchLogComponent):
         utils.format_log_line(
@@ -325,6 +337,33 @@ def test_load_system_paasta_config():
         )
 
 
+def test_load_system_paasta_config_is_cached_until_modified(tmpdir):
+    config_file = tmpdir.join("cluster.json")
+    config_file.write('{"cluster": "foo"}')
+    with mock.patch(
+        "paasta_tools.utils.json.load", autospec=True, side_effect=json.load
+    ) as json_patch:
+        assert utils.load_system_paasta_config(tmpdir.strpath).get_cluster() == "foo"
+        # Reading the file (which may bump its atime) mustn't invalidate the cache
+        config_file.read()
+        assert utils.load_system_paasta_config(tmpdir.strpath).get_cluster() == "foo"
+        assert json_patch.call_count == 1
+
+        config_file.write('{"cluster": "barbaz"}')
+        assert utils.load_system_paasta_config(tmpdir.strpath).get_cluster() == "barbaz"
+        assert json_patch.call_count == 2
+
+        # Replacing the file with a same-sized copy that keeps the old mtime
+        # must still be noticed.
+        new_file = tmpdir.join("new.json.tmp")
+        new_file.write('{"cluster": "quxfoo"}')
+        mtime_ns = os.stat(config_file.strpath).st_mtime_ns
+        os.utime(new_file.strpath, ns=(mtime_ns, mtime_ns))
+        os.rename(new_file.strpath, config_file.strpath)
+        assert utils.load_system_paasta_config(tmpdir.strpath).get_cluster() == "quxfoo"
+        assert json_patch.call_count == 3
+
+
 def test_load_system_paasta_config_file_non_existent_dir():
     fake_path = "/var/dir_of_fake"
     with mock.patch("os.path.isdir", return_value=False, autospec=True):
@@ -667,6 +706,90 @@ def test_configure_log():
             )
 
 
+def test_get_log_line_writer_is_started_once():
+    mock_clog = mock.Mock()
+    with mock.patch("paasta_tools.utils.clog", mock_clog, create=True), mock.patch(
+        "paasta_tools.utils._log_line_writer", None
+    ), mock.patch("paasta_tools.utils.atexit", autospec=True) as mock_atexit:
+        writer = utils._get_log_line_writer()
+        for line in ("line1", "line2", "line3"):
+            assert utils._get_log_line_writer() is writer
+            writer.write("fake_log", line)
+        writer.flush()
+
+        assert mock_clog.log_line.call_args_list == [
+            mock.call("fake_log", "line1"),
+            mock.call("fake_log", "line2"),
+            mock.call("fake_log", "line3"),
+        ]
+        mock_atexit.register.assert_called_once_with(writer.flush)
+
+
+class _BlockingWriteLine:
+    """A write_line for _BackgroundLineWriter that holds the worker on each
+    line until release is set."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.written = []
+
+    def __call__(self, log_name, line):
+        self.started.set()
+        self.release.wait()
+        self.written.append(line)
+
+
+def test_BackgroundLineWriter_blocks_when_queue_is_full():
+    write_line = _BlockingWriteLine()
+    writer = utils._BackgroundLineWriter(write_line, maxsize=2)
+    lines = [f"line{i}" for i in range(6)]
+
+    writer.write("fake_log", lines[0])
+    write_line.started.wait()
+    # The worker is holding line0, so these two fill the queue
+    writer.write("fake_log", lines[1])
+    writer.write("fake_log", lines[2])
+    assert writer._queue.full()
+
+    producer = threading.Thread(
+        target=lambda: [writer.write("fake_log", line) for line in lines[3:]]
+    )
+    producer.start()
+    assert producer.is_alive()
+
+    write_line.release.set()
+    producer.join()
+    writer.flush()
+    assert write_line.written == lines
+
+
+def test_BackgroundLineWriter_drops_lines_when_queue_stays_full(capsys):
+    write_line = _BlockingWriteLine()
+    writer = utils._BackgroundLineWriter(write_line, maxsize=1, put_timeout=0)
+
+    writer.write("fake_log", "line1")
+    write_line.started.wait()
+    writer.write("fake_log", "line2")
+    writer.write("fake_log", "line3")
+
+    write_line.release.set()
+    writer.flush()
+    assert "log queue is full" in capsys.readouterr().err
+    assert write_line.written == ["line1", "line2"]
+
+
+def test_BackgroundLineWriter_flush_gives_up_on_a_stuck_writer():
+    write_line = _BlockingWriteLine()
+    writer = utils._BackgroundLineWriter(write_line)
+    writer.write("fake_log", "line1")
+    write_line.started.wait()
+
+    writer.flush(timeout=0)
+    assert writer._queue.unfinished_tasks == 1
+    write_line.release.set()
+
+
 def test_compose_job_id_without_hashes():
     fake_service = "my_cool_service"
     fake_instance = "main"
@@ -752,7 +875,7 @@ def test_check_docker_image_false(mock_build_docker_image_name):
     fake_commit = "fake_commit"
     docker_tag = utils.build_docker_tag(fake_app, fake_commit)
     with mock.patch(
-        "paasta_tools.utils.get_docker_client", autospec=True
+        "paasta_tools.utils._get_shared_docker_client", autospec=True
     ) as mock_docker:
         docker_client = mock_docker.return_value
         docker_client.images.return_value = [
@@ -775,7 +898,7 @@ def test_check_docker_image_true(mock_build_docker_image_name):
     mock_build_docker_image_name.return_value = "fake-registry/services-foo"
     docker_tag = utils.build_docker_tag(fake_app, fake_commit)
     with mock.patch(
-        "paasta_tools.utils.get_docker_client", autospec=True
+        "paasta_tools.utils._get_shared_docker_client", autospec=True
     ) as mock_docker:
         docker_client = mock_docker.return_value
         docker_client.images.return_value = [
@@ -788,13 +911,67 @@ def test_check_docker_image_true(mock_build_docker_image_name):
                 "Size": 0,
             }
         ]
+        mock_build_docker_image_name.reset_mock()
         assert utils.check_docker_image(fake_app, fake_commit) is True
+        mock_build_docker_image_name.assert_called_once_with(fake_app)
+
+
+@mock.patch("paasta_tools.utils.build_docker_image_name", autospec=True)
+def test_check_docker_image_raises_on_duplicate_tags(mock_build_docker_image_name):
+    mock_build_docker_image_name.return_value = "fake-registry/services-foo"
+    docker_tag = utils.build_docker_tag("fake_app", "fake_commit")
+    with mock.patch(
+        "paasta_tools.utils._get_shared_docker_client", autospec=True
+    ) as mock_docker:
+        docker_client = mock_docker.return_value
+        docker_client.images.return_value = [
+            {"RepoTags": [docker_tag], "Id": "1111"},
+            {"RepoTags": None, "Id": "2222"},
+            {"RepoTags": [docker_tag], "Id": "3333"},
+        ]
+        with raises(ValueError):
+            utils.check_docker_image("fake_app", "fake_commit")
+
+
+def test_get_shared_docker_client_reuses_client():
+    with mock.patch(
+        "paasta_tools.utils.get_docker_client", autospec=True
+    ) as mock_get_docker_client, mock.patch(
+        "paasta_tools.utils._shared_docker_client", None
+    ):
+        first = utils._get_shared_docker_client()
+        assert utils._get_shared_docker_client() is first
+        assert mock_get_docker_client.call_count == 1
+
+
+def test_get_username_prefers_sudo_user():
+    with mock.patch.dict(os.environ, {"SUDO_USER": "fake_sudo_user"}), mock.patch(
+        "paasta_tools.utils.pwd.getpwuid", autospec=True
+    ) as mock_getpwuid:
+        assert utils.get_username() == "fake_sudo_user"
+        assert mock_getpwuid.call_count == 0
+
+
+def test_get_username_looks_up_uid_once():
+    utils._get_username_for_uid.cache_clear()
+    with mock.patch.dict(os.environ, clear=True), mock.patch(
+        "paasta_tools.utils.pwd.getpwuid", autospec=True, return_value=("fake_user",)
+    ) as mock_getpwuid:
+        assert utils.get_username() == "fake_user"
+        assert utils.get_username() == "fake_user"
+        assert mock_getpwuid.call_count == 1
+    utils._get_username_for_uid.cache_clear()
 
 
 def test_remove_ansi_escape_sequences():
     plain_string = "blackandwhite"
     colored_string = "\033[34m" + plain_string + "\033[0m"
     assert utils.remove_ansi_escape_sequences(colored_string) == plain_string
+    assert utils.remove_ansi_escape_sequences(plain_string) == plain_string
+    cursor_string = "\033[2K\033[1;31m" + plain_string + "\033[?25h"
+    assert utils.remove_ansi_escape_sequences(cursor_string) == plain_string
+    progress_string = "\r" + plain_string + "\a\r"
+    assert utils.remove_ansi_escape_sequences(progress_string) == plain_string
 
 
 def test_missing_cluster_configs_are_ignored():
@@ -1233,20 +1410,40 @@ def test_get_running_mesos_docker_containers():
         assert len(utils.get_running_mesos_docker_containers()) == 1
 
 
-def test_run_cancels_timer_thread_on_keyboard_interrupt():
-    mock_process = mock.Mock()
-    mock_timer_object = mock.Mock()
-    with mock.patch(
-        "paasta_tools.utils.Popen", autospec=True, return_value=mock_process
-    ), mock.patch(
-        "paasta_tools.utils.threading.Timer",
-        autospec=True,
-        return_value=mock_timer_object,
-    ):
-        mock_process.stdout.readline.side_effect = KeyboardInterrupt
-        with raises(KeyboardInterrupt):
-            utils._run("sh echo foo", timeout=10)
-        assert mock_timer_object.cancel.call_count == 1
+def test_run_with_timeout_returns_output():
+    # Popen.wait(timeout=...) polls with time.sleep
+    with mock.patch("time.sleep", time.true_slow_sleep):  # type: ignore
+        return_code, output = utils._run("printf 'foo\\nbar'", timeout=10)
+    assert return_code == 0
+    assert output == "foo\nbar"
+
+
+def test_run_returns_output_lines():
+    return_code, output = utils._run("printf 'foo\\n\\nbar\\n\\n'")
+    assert return_code == 0
+    assert output == "foo\n\nbar\n"
+
+
+def test_run_kills_process_on_timeout():
+    return_code, output = utils._run("sleep 10", timeout=0.1)
+    assert return_code == -9
+    assert "timed out" in output
+
+
+def test_run_kills_process_on_timeout_after_stdout_closes():
+    # Popen.wait(timeout=...) polls with time.sleep
+    with mock.patch("time.sleep", time.true_slow_sleep):  # type: ignore
+        return_code, output = utils._run(
+            ["sh", "-c", "exec >&- 2>&-; sleep 10"], timeout=0.5
+        )
+    assert return_code == -9
+    assert "timed out" in output
+
+
+def test_run_kills_process_on_timeout_while_it_keeps_writing():
+    return_code, output = utils._run("yes", timeout=0.5)
+    assert return_code == -9
+    assert "timed out" in output
 
 
 def test_run_returns_when_popen_fails():